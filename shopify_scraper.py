@@ -1,178 +1,650 @@
 import asyncio
+import concurrent.futures
+import functools
 import aiohttp
+import aiofiles
+import httpx
+import tiktoken
+import hashlib
+import importlib.util
 import json
+import logging
+import logging.handlers
+import orjson
+import simdjson
 import os
 import re
 import time
-from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning, Comment
-from urllib.parse import urlparse, urljoin
+import uuid
+from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning, Comment, Tag
+from selectolax.lexbor import LexborHTMLParser
+from html import unescape
+from urllib.parse import urlparse
+from yarl import URL
 import warnings
-from openai import OpenAI
+from collections import deque
+from queue import SimpleQueue
+from openai import AsyncOpenAI
+from aiolimiter import AsyncLimiter
+from pybloom_live import ScalableBloomFilter
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:  # uvloop does not support Windows
+    uvloop = None
+
 # Load environment variables
 load_dotenv()
 
+log = logging.getLogger("shopify_scraper")
+
 # Ignore XMLParsedAsHTMLWarning
 warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
 
-# Add OpenAI API key
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Add OpenAI API key. The async client multiplexes concurrent requests over
+# HTTP/2 (when the h2 package is installed) instead of tying up a thread per call
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.AsyncClient(
+        http2=importlib.util.find_spec('h2') is not None,
+        limits=httpx.Limits(max_connections=64),
+    ),
+)
+
+# Concurrency limits for product page fetches and OpenAI calls
+FETCH_CONCURRENCY = 16
+LLM_CONCURRENCY = 8
+
+# Number of concurrent crawler workers
+CRAWL_WORKERS = 32
+
+# One HTTP session serves both the crawl and product fetching. Timeouts and
+# transient 5xx responses are retried with exponential backoff, starting at
+# HTTP_RETRY_BACKOFF seconds
+HTTP_CONNECTION_LIMIT = 128
+HTTP_CONNECTION_LIMIT_PER_HOST = 32
+HTTP_RETRY_ATTEMPTS = 3
+HTTP_RETRY_BACKOFF = 1
+HTTP_HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+# aiohttp can only decode br responses when a Brotli package is installed;
+# otherwise its default Accept-Encoding is left alone
+if any(importlib.util.find_spec(name) for name in ('brotli', 'brotlicffi')):
+    HTTP_HEADERS["Accept-Encoding"] = "gzip, br"
+
+# The sitemap writer flushes every SITEMAP_FLUSH_EVERY URLs and at least
+# once per SITEMAP_FLUSH_INTERVAL seconds
+SITEMAP_FLUSH_EVERY = 128
+SITEMAP_FLUSH_INTERVAL = 1
+
+# Tags, classes and ids that usually hold non-product content
+NON_PRODUCT_TAGS = {'header', 'footer', 'nav'}
+NON_PRODUCT_PATTERN = re.compile(r'menu|sidebar|ad|comment|footer|header|navigation')
+
+NON_PRODUCT_NOTE = "<!-- Sections marked with data-section='non-product' are likely not part of the main product information -->\n"
+
+# schema.org types that carry a full product. Shopify marks products with
+# variants as ProductGroup
+PRODUCT_JSON_LD_TYPES = {'Product', 'ProductGroup'}
+
+# Candidate containers for the main product content, most specific first
+PRODUCT_REGION_SELECTORS = ('[itemtype$="Product"]', '#ProductSection', 'main', '.product')
+
+# Matches the href of every anchor tag in raw HTML bytes
+HREF_PATTERN = re.compile(rb'<a\b[^>]*?\shref=["\']([^"\']+)["\']', re.I)
+
+# OpenAI model and the static system instruction sent with every request.
+# Extraction is deterministic so identical pages give identical, cacheable
+# responses; MAX_TOKENS is the reply ceiling per product
+MODEL = "gpt-4o-mini"
+TEMPERATURE = 0
+MAX_TOKENS = 2000
+SYSTEM_PROMPT = "You are a helpful assistant that extracts and cleans product information from HTML content."
+
+# The system instruction and one of these prompts form the first message and
+# the page HTML is sent on its own last. OpenAI's server-side prompt caching
+# only applies to identical prefixes of 1024+ tokens, which these sub-200-token
+# instructions do not reach, so repeats are served by the local cache in CACHE_DIR
+PRODUCT_PROMPT = """This is the HTML content of an e-commerce product page. Some sections are marked with data-section='non-product' to indicate they might not be part of the main product information. Please extract and present the product information in JSON format, focusing on the unmarked sections but also considering marked sections if they contain relevant product details. Include core product attributes like product name, description, price, and any other available attributes. Preserve the original wording and details as provided by the brand. Make it detailed and comprehensive. Respond with just your polished cleaned JSON version. Here is the HTML content:
+
+"""
+REDUCED_PRODUCT_PROMPT = """This is the reduced HTML content of an e-commerce product page with header and footer removed. Please extract and present the product information in JSON format. Include core product attributes like product name, description, price, and any other available attributes. Preserve the original wording and details as provided by the brand. Make it detailed and comprehensive. Respond with just your polished cleaned JSON version. Here is the reduced HTML content:
+
+"""
+
+BATCH_PRODUCT_PROMPT = """These are the HTML contents of several e-commerce product pages, each starting with a ---PAGE n--- line. Some sections are marked with data-section='non-product' to indicate they might not be part of the main product information. For each page, extract the product information as a JSON object, focusing on the unmarked sections but also considering marked sections if they contain relevant product details. Include core product attributes like product name, description, price, and any other available attributes. Preserve the original wording and details as provided by the brand. Make it detailed and comprehensive. Respond with just a JSON object whose "products" array contains one object per page, in the same order as the pages. Here are the pages:
+
+"""
+
+# Page HTML is counted locally before sending. PROMPT_TOKEN_BUDGET leaves room
+# in gpt-4o-mini's 128k context for the instructions and the reply
+PROMPT_TOKEN_BUDGET = 110_000
+
+# Up to BATCH_SIZE pages are sent in one request, waiting at most BATCH_TIMEOUT
+# seconds for a batch to fill. Pages over BATCH_MAX_PAGE_TOKENS are sent on
+# their own so a full batch stays within the token budget
+BATCH_SIZE = 4
+BATCH_TIMEOUT = 0.25
+BATCH_MAX_PAGE_TOKENS = PROMPT_TOKEN_BUDGET // BATCH_SIZE
+
+# On-disk cache of GPT responses, keyed by a hash of the full request
+CACHE_DIR = ".gpt_cache"
+
+# Reused simdjson parser; results are converted to plain dicts/lists right away
+json_parser = simdjson.Parser()
+
+# Token bucket matching the OpenAI requests-per-minute limit
+openai_limiter = AsyncLimiter(max_rate=500, time_period=60)
 
 @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-async def get_gpt4_response(prompt):
+async def get_gpt4_response(instructions, content, max_tokens=MAX_TOKENS):
     try:
-        response = await asyncio.to_thread(
-            client.chat.completions.create,
-            model="gpt-4o-mini",  
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that extracts and cleans product information from HTML content."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=4000  # Increased max tokens for longer responses
-        )
+        async with openai_limiter:
+            response = await client.chat.completions.create(
+                model=MODEL,
+                messages=[
+                    {"role": "system", "content": f"{SYSTEM_PROMPT}\n\n{instructions}"},
+                    {"role": "user", "content": content}
+                ],
+                temperature=TEMPERATURE,
+                max_tokens=max_tokens,
+                response_format={"type": "json_object"}  # Always valid JSON, no code fences
+            )
         return response.choices[0].message.content.strip()
     except Exception as e:
-        print(f"Error in OpenAI API call: {e}")
+        log.error(f"Error in OpenAI API call: {e}")
         raise
 
-def preprocess_html(html):
+def get_cache_path(instructions, content, max_tokens):
+    request = f"{MODEL}|{TEMPERATURE}|{max_tokens}|{SYSTEM_PROMPT}|{instructions}|{content}"
+    key = hashlib.sha256(request.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.json")
+
+async def read_cached_response(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    async with aiofiles.open(cache_path, 'rb') as f:
+        return orjson.loads(await f.read())['response']
+
+async def write_cached_response(cache_path, response):
+    # Write to a temporary file and rename so a crash never leaves a partial entry
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"  # Unique even for concurrent identical requests
+    async with aiofiles.open(tmp_path, 'wb') as f:
+        await f.write(orjson.dumps({"model": MODEL, "response": response}))
+    os.replace(tmp_path, cache_path)
+
+async def get_cached_gpt4_response(instructions, content, max_tokens=MAX_TOKENS):
+    cache_path = get_cache_path(instructions, content, max_tokens)
+    response = await read_cached_response(cache_path)
+    if response is None:
+        response = await get_gpt4_response(instructions, content, max_tokens)
+        await write_cached_response(cache_path, response)
+    return response
+
+def preprocess_html_bs4(html):
     soup = BeautifulSoup(html, 'lxml')
 
-    # Remove script and style elements
-    for script in soup(["script", "style"]):
-        script.decompose()
-
-    # Remove comments
-    for comment in soup.find_all(string=lambda string: isinstance(string, Comment)):
-        comment.extract()
-
-    # Instead of removing, let's just mark potential non-product areas
-    for elem in soup(['header', 'footer', 'nav']):
-        elem['data-section'] = 'non-product'
+    # Single pass over the tree instead of one scan per selector
+    for elem in list(soup.descendants):
+        # Remove comments
+        if isinstance(elem, Comment):
+            elem.extract()
+            continue
+        if not isinstance(elem, Tag) or elem.decomposed:
+            continue
+
+        # Remove script and style elements
+        if elem.name in ('script', 'style'):
+            elem.decompose()
+            continue
+
+        # Instead of removing, let's just mark potential non-product areas
+        class_and_id = ' '.join(elem.get('class', ())) + ' ' + elem.get('id', '')
+        if elem.name in NON_PRODUCT_TAGS or NON_PRODUCT_PATTERN.search(class_and_id):
+            elem['data-section'] = 'non-product'
 
-    for elem in soup(class_=re.compile(r'menu|sidebar|ad|comment|footer|header|navigation')):
-        elem['data-section'] = 'non-product'
+    # Convert to string, maintaining the structure
+    return str(soup)
 
-    for elem in soup(id=re.compile(r'menu|sidebar|ad|comment|footer|header|navigation')):
-        elem['data-section'] = 'non-product'
+def extract_product_json_ld(tree):
+    # Most Shopify themes embed the full product as schema.org JSON-LD
+    for node in tree.css('script[type="application/ld+json"]'):
+        text = node.text()
+        try:
+            data = orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # Themes often leave raw newlines in descriptions, which only the lenient stdlib parser accepts
+            try:
+                data = json.loads(text, strict=False)
+            except ValueError:
+                continue
+        if isinstance(data, dict):
+            data = data.get('@graph', [data])
+        for item in data if isinstance(data, list) else []:
+            if not isinstance(item, dict):
+                continue
+            item_type = item.get('@type')
+            types = item_type if isinstance(item_type, list) else [item_type]
+            if any(t in PRODUCT_JSON_LD_TYPES for t in types if isinstance(t, str)):
+                return item
+    return None
+
+def preprocess_html_selectolax(tree):
+    if tree.root is None:
+        raise ValueError("selectolax could not parse the document")
+
+    # Only send the likely product region to GPT when the theme exposes one
+    root = tree.root
+    for selector in PRODUCT_REGION_SELECTORS:
+        region = tree.css_first(selector)
+        if region is not None:
+            root = region
+            break
 
-    # Convert to string, maintaining the structure
-    html_string = str(soup)
+    # Remove script and style elements
+    for node in root.css('script, style'):
+        node.decompose()
+
+    # Single pass: drop comments and mark potential non-product areas
+    for node in list(root.traverse(include_text=False)):
+        if node.tag == '-comment':
+            node.decompose()
+            continue
+        attrs = node.attributes
+        class_and_id = (attrs.get('class') or '') + ' ' + (attrs.get('id') or '')
+        if node.tag in NON_PRODUCT_TAGS or NON_PRODUCT_PATTERN.search(class_and_id):
+            node.attrs['data-section'] = 'non-product'
+
+    return root.html
+
+def preprocess_html(html, tree=None):
+    try:
+        if tree is None:
+            tree = LexborHTMLParser(html)
+        html_string = preprocess_html_selectolax(tree)
+    except Exception:
+        # Fall back to BeautifulSoup if selectolax rejects the document
+        html_string = preprocess_html_bs4(html)
 
     # Add a note for GPT about the marked sections
-    html_string = "<!-- Sections marked with data-section='non-product' are likely not part of the main product information -->\n" + html_string
+    html_string = NON_PRODUCT_NOTE + html_string
 
     return html_string
 
-async def process_product_urls(session, product_urls, folder_name):
-    for i, url in enumerate(product_urls):
-        if i > 0 and i % 15 == 0:
-            await asyncio.sleep(60)  # Wait for 60 seconds after every 15 requests
+def parse_json_response(text):
+    # JSON mode guarantees the response is a bare JSON object
+    doc = json_parser.parse(text.encode())
+    if isinstance(doc, simdjson.Object):
+        return doc.as_dict()
+    if isinstance(doc, simdjson.Array):
+        return doc.as_list()
+    return doc
+
+async def run_gpt4_batch(batch, llm_sem):
+    if len(batch) == 1:
+        html, future = batch[0]
+        try:
+            async with llm_sem:
+                response = await get_cached_gpt4_response(PRODUCT_PROMPT, html)
+            future.set_result(response)
+        except Exception as e:
+            future.set_exception(e)
+        return
+
+    # Batch membership depends on timing, so the batch request itself is not
+    # cached; each page's result is cached under its own single-page key instead
+    pages = "\n".join(f"---PAGE {i}---\n{html}" for i, (html, _) in enumerate(batch, 1))
+    try:
+        async with llm_sem:
+            response = await get_gpt4_response(BATCH_PRODUCT_PROMPT, pages, MAX_TOKENS * len(batch))
+        result = parse_json_response(response)
+        products = result.get('products') if isinstance(result, dict) else None
+        if not isinstance(products, list) or len(products) != len(batch):
+            raise ValueError("response is not one JSON object per page")
+    except Exception as e:
+        log.warning(f"Batch of {len(batch)} pages failed ({e}). Retrying pages individually...")
+        await asyncio.gather(*(run_gpt4_batch([item], llm_sem) for item in batch))
+        return
 
+    # Hand each page its own slice of the response
+    retry_items = []
+    for (html, future), product in zip(batch, products):
+        if not isinstance(product, dict):
+            retry_items.append((html, future))
+            continue
+        response = orjson.dumps(product).decode()
         try:
-            product_name = url.split('/')[-1]
-            file_name = os.path.join(folder_name, f"{product_name}.json")
-            
-            if os.path.exists(file_name):
-                print(f"File {file_name} already exists. Skipping.")
-                continue
+            await write_cached_response(get_cache_path(PRODUCT_PROMPT, html, MAX_TOKENS), response)
+        except OSError as e:
+            log.warning(f"Could not cache batched response: {e}")
+        future.set_result(response)
+
+    if retry_items:
+        log.warning(f"Batch returned {len(retry_items)} invalid entries. Retrying those pages individually...")
+        await asyncio.gather(*(run_gpt4_batch([item], llm_sem) for item in retry_items))
+
+async def batch_gpt4_requests(batch_queue, llm_sem):
+    loop = asyncio.get_running_loop()
+    running = set()
+    while True:
+        batch = [await batch_queue.get()]
+        deadline = loop.time() + BATCH_TIMEOUT
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), timeout=deadline - loop.time()))
+            except asyncio.TimeoutError:
+                break
 
-            async with session.get(url, headers={"User-Agent": "Mozilla/5.0"}) as response:
-                if response.status == 200:
-                    html = await response.text()
-                    
-                    # Preprocess HTML
-                    preprocessed_html = preprocess_html(html)
-                    
-                    # Prepare prompt for GPT-4
-                    prompt = f"""This is the HTML content of an e-commerce product page. Some sections are marked with data-section='non-product' to indicate they might not be part of the main product information. Please extract and present the product information in JSON format, focusing on the unmarked sections but also considering marked sections if they contain relevant product details. Include core product attributes like product name, description, price, and any other available attributes. Preserve the original wording and details as provided by the brand. Make it detailed and comprehensive. Respond with just your polished cleaned JSON version. Here is the HTML content:
-
-{preprocessed_html}"""
-
-                    try:
-                        # Get response from GPT-4
-                        cleaned_text = await get_gpt4_response(prompt)
-                    except Exception as e:
-                        if "context_length_exceeded" in str(e):
-                            print(f"Context length exceeded for {url}. Retrying with reduced content...")
-                            # Remove header and footer content
-                            soup = BeautifulSoup(html, 'lxml')
-                            for elem in soup(['header', 'footer', 'nav']):
-                                elem.decompose()
-                            reduced_html = str(soup)
-                            reduced_prompt = f"""This is the reduced HTML content of an e-commerce product page with header and footer removed. Please extract and present the product information in JSON format. Include core product attributes like product name, description, price, and any other available attributes. Preserve the original wording and details as provided by the brand. Make it detailed and comprehensive. Respond with just your polished cleaned JSON version. Here is the reduced HTML content:
-
-{reduced_html}"""
-                            cleaned_text = await get_gpt4_response(reduced_prompt)
-                        else:
-                            raise e
-
-                    # Clean up the JSON response
-                    cleaned_json = cleaned_text.strip()
-                    if cleaned_json.startswith('```json'):
-                        cleaned_json = cleaned_json[7:]
-                    if cleaned_json.endswith('```'):
-                        cleaned_json = cleaned_json[:-3]
-                    
-                    # Parse and re-serialize the JSON to ensure proper formatting
-                    try:
-                        json_data = json.loads(cleaned_json)
-                        json_data['url'] = url  # Add the URL to the JSON data
-                        
-                        with open(file_name, 'w', encoding='utf-8') as f:
-                            json.dump(json_data, f, ensure_ascii=False, indent=2)
-                        print(f"Saved cleaned content for {file_name}")
-                    except json.JSONDecodeError as e:
-                        print(f"Error parsing JSON for {url}: {e}")
-                        # Optionally, save the raw text if JSON parsing fails
-                        with open(f"{file_name}.txt", 'w', encoding='utf-8') as f:
-                            f.write(f"URL: {url}\n\n")
-                            f.write(cleaned_text)
-                        print(f"Saved raw text for {file_name}.txt due to JSON parsing error")
-                else:
-                    print(f"Failed to retrieve data for {url}. Status code: {response.status}")
-        except Exception as e:
-            print(f"An error occurred for {url}: {e}")
+        task = asyncio.create_task(run_gpt4_batch(batch, llm_sem))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+async def get_batched_gpt4_response(batch_queue, html):
+    # Pages answered in an earlier run are served from the cache without queueing
+    response = await read_cached_response(get_cache_path(PRODUCT_PROMPT, html, MAX_TOKENS))
+    if response is not None:
+        return response
+
+    future = asyncio.get_running_loop().create_future()
+    await batch_queue.put((html, future))
+    return await future
+
+@functools.cache
+def get_encoding():
+    # Loaded on first use rather than at import: the first load downloads the
+    # BPE file, which should only affect pages that actually go to GPT. Cached
+    # per process, so each parse worker loads it at most once
+    return tiktoken.encoding_for_model(MODEL)
+
+def count_tokens(text):
+    # Page HTML may contain literal special-token strings, which must not raise
+    return get_encoding().encode(text, disallowed_special=())
+
+def reduce_html(preprocessed_html):
+    # Remove header, footer and nav content. Class/id matches stay as a marking
+    # hint only, since the pattern also hits names like "gradient" or "badge"
+    tree = LexborHTMLParser(preprocessed_html)
+    for node in tree.css(', '.join(sorted(NON_PRODUCT_TAGS))):
+        node.decompose()
+    return tree.html
+
+def parse_product_page(html):
+    # Runs in a worker process, so the result must be picklable. Returns the
+    # product JSON-LD, or the page HTML to send to GPT with its token count and
+    # whether it had to be reduced to fit the token budget
+    tree = LexborHTMLParser(html)
+    json_data = extract_product_json_ld(tree)
+    if json_data is not None:
+        return json_data, None, 0, False
+
+    page_html = preprocess_html(html, tree)
+    tokens = count_tokens(page_html)
+    if len(tokens) <= PROMPT_TOKEN_BUDGET:
+        return None, page_html, len(tokens), False
+
+    page_html = reduce_html(page_html)
+    tokens = count_tokens(page_html)
+    if len(tokens) > PROMPT_TOKEN_BUDGET:
+        # Still too long: keep the start of the page, where product details usually are
+        tokens = tokens[:PROMPT_TOKEN_BUDGET]
+        page_html = get_encoding().decode(tokens)
+    return None, page_html, len(tokens), True
+
+async def save_product_json(json_data, url, file_name):
+    json_data['url'] = url  # Add the URL to the JSON data
+
+    async with aiofiles.open(file_name, 'wb') as f:
+        await f.write(orjson.dumps(json_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    log.info(f"Saved cleaned content for {file_name}")
+
+async def fetch_page(session, url):
+    # The body is read inside the retried attempt, so a page that stalls mid-download
+    # is fetched again. Returns the final status and the body of a 200 response;
+    # raises asyncio.TimeoutError once every attempt has timed out
+    for attempt in range(1, HTTP_RETRY_ATTEMPTS + 1):
+        try:
+            async with session.get(url) as response:
+                if response.status < 500 or attempt == HTTP_RETRY_ATTEMPTS:
+                    # Raw bytes go straight to the parser, skipping the str decode
+                    return response.status, (await response.read() if response.status == 200 else None)
+                log.warning(f"Status code {response.status} for {url}. Retrying... (Attempt {attempt}/{HTTP_RETRY_ATTEMPTS})")
+        except asyncio.TimeoutError:
+            if attempt == HTTP_RETRY_ATTEMPTS:
+                raise
+            log.warning(f"Timeout occurred for {url}. Retrying... (Attempt {attempt}/{HTTP_RETRY_ATTEMPTS})")
+        await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** (attempt - 1))
 
+async def process_one(session, url, folder_name, existing_files, fetch_sem, llm_sem, batch_queue, parse_executor):
+    try:
+        product_name = url.split('/')[-1]
+        json_name = f"{product_name}.json"
+        file_name = os.path.join(folder_name, json_name)
 
-async def get_internal_links(session, base_url, url, visited_urls, file, max_retries=3):
-    if url in visited_urls:
-        return
+        if json_name in existing_files:
+            log.info(f"File {file_name} already exists. Skipping.")
+            return
 
-    visited_urls.add(url)
-    print(f"Crawling: {url}")
-    file.write(url + '\n')
-    file.flush()
+        # Only hold a fetch slot while the page is downloading
+        try:
+            async with fetch_sem:
+                status, html = await fetch_page(session, url)
+        except asyncio.TimeoutError:
+            log.warning(f"Max retries reached for {url}. Moving on...")
+            return
+        if status != 200:
+            log.warning(f"Failed to retrieve data for {url}. Status code: {status}")
+            return
+
+        # Parsing is CPU-bound, so it runs in the process pool and leaves the event loop free
+        loop = asyncio.get_running_loop()
+        json_data, page_html, n_tokens, reduced = await loop.run_in_executor(parse_executor, parse_product_page, html)
+
+        # Skip GPT entirely when the page already carries structured product data
+        if json_data is not None:
+            await save_product_json(json_data, url, file_name)
+            return
+
+        # Get response from GPT-4. Pages were already fitted to the token budget,
+        # so the request is never rejected for its context length
+        if reduced:
+            log.warning(f"Token budget exceeded for {url}. Sending reduced content...")
+            async with llm_sem:
+                cleaned_text = await get_cached_gpt4_response(REDUCED_PRODUCT_PROMPT, page_html)
+        elif n_tokens <= BATCH_MAX_PAGE_TOKENS:
+            # Batched with other pages when it is small enough
+            cleaned_text = await get_batched_gpt4_response(batch_queue, page_html)
+        else:
+            async with llm_sem:
+                cleaned_text = await get_cached_gpt4_response(PRODUCT_PROMPT, page_html)
+
+        # Parse and re-serialize the JSON to ensure proper formatting
+        try:
+            json_data = parse_json_response(cleaned_text)
+            await save_product_json(json_data, url, file_name)
+        except ValueError as e:
+            log.error(f"Error parsing JSON for {url}: {e}")
+            # Optionally, save the raw text if JSON parsing fails
+            async with aiofiles.open(f"{file_name}.txt", 'w', encoding='utf-8') as f:
+                await f.write(f"URL: {url}\n\n{cleaned_text}")
+            log.info(f"Saved raw text for {file_name}.txt due to JSON parsing error")
+    except Exception as e:
+        log.error(f"An error occurred for {url}: {e}")
 
-    for attempt in range(max_retries):
+async def process_product_urls(session, product_urls, folder_name):
+    # The same product handle can be linked from several paths, e.g. under a
+    # collection; all of them write the same file, so keep only the first
+    unique_urls = {}
+    for url in product_urls:
+        unique_urls.setdefault(url.split('/')[-1], url)
+    product_urls = list(unique_urls.values())
+
+    # List the output folder once instead of checking every product file separately
+    try:
+        existing_files = {f for f in os.listdir(folder_name) if f.endswith('.json')}
+    except FileNotFoundError:
+        existing_files = set()
+
+    # Separate limits so page downloads and GPT calls overlap across products
+    fetch_sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    llm_sem = asyncio.Semaphore(LLM_CONCURRENCY)
+
+    # Pages waiting for GPT are grouped into batches by a single coroutine
+    batch_queue = asyncio.Queue()
+    batcher = asyncio.create_task(batch_gpt4_requests(batch_queue, llm_sem))
+
+    # HTML parsing is sized to the CPU; network and GPT concurrency are limited separately above
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as parse_executor:
+        tasks = [
+            process_one(session, url, folder_name, existing_files, fetch_sem, llm_sem, batch_queue, parse_executor)
+            for url in product_urls
+        ]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    batcher.cancel()
+    await asyncio.gather(batcher, return_exceptions=True)
+
+
+class VisitedUrls:
+    # Bloom filter over every crawled URL, using far less memory than a set on
+    # large stores. A rare false positive only means one page is not crawled.
+    # The most recent URLs are also kept exactly, so repeated lookups of hot
+    # links (menus, footers) are answered without hashing into the filter
+    def __init__(self, recent_size=4096):
+        self.bloom = ScalableBloomFilter(initial_capacity=100_000, error_rate=1e-4)
+        self.recent = set()
+        self.recent_order = deque()
+        self.recent_size = recent_size
+
+    def __contains__(self, url):
+        return url in self.recent or url in self.bloom
+
+    def add(self, url):
+        self.bloom.add(url)
+        if url not in self.recent:
+            self.recent.add(url)
+            self.recent_order.append(url)
+            if len(self.recent_order) > self.recent_size:
+                self.recent.discard(self.recent_order.popleft())
+
+def canonicalize_url(url):
+    # Lowercase, drop the query string and fragment, and remove trailing slashes
+    return str(url.with_query(None).with_fragment(None)).lower().rstrip('/')
+
+def crawl_key(url):
+    # Dedupe key for fetching: the canonical URL plus its page number, so
+    # paginated collections are still crawled and their products found
+    page = url.query.get('page')
+    key = canonicalize_url(url)
+    return f"{key}?page={page}" if page else key
+
+def enqueue_links(hrefs, base, base_netloc, visited_urls, queue):
+    for href in hrefs:
+        href = unescape(href.decode('utf-8', 'ignore'))
         try:
-            async with session.get(url, timeout=30) as response:
-                if response.status == 200:
-                    html = await response.text()
-                    soup = BeautifulSoup(html, 'lxml')  # Using lxml parser
-                    sub_links = [urljoin(base_url, a['href']) for a in soup.find_all('a', href=True)]
-                    tasks = []
-                    for link in sub_links:
-                        parsed_link = urlparse(link)
-                        if parsed_link.netloc == urlparse(base_url).netloc and link not in visited_urls:
-                            task = asyncio.ensure_future(get_internal_links(session, base_url, link, visited_urls, file))
-                            tasks.append(task)
-                    await asyncio.gather(*tasks)
-                else:
-                    print(f"Failed to retrieve data from {url}. Status code: {response.status}")
+            link = base.join(URL(href))
+        except ValueError:
+            continue
+        if link.raw_authority == base_netloc:
+            # Mark links seen on the normalized key as they are queued, so variants of
+            # a page are queued once, but queue the real link so it is fetched as it appears
+            key = crawl_key(link)
+            if key not in visited_urls:
+                visited_urls.add(key)
+                queue.put_nowait(link)
+
+async def crawl_page(session, base, base_netloc, url, visited_urls, sitemap_queue, queue):
+    # Links are marked visited when queued, so every URL here is fetched exactly once
+    log.info(f"Crawling: {url}")
+
+    # Several crawled variants can share a canonical URL; repeats are removed
+    # exactly when the sitemap is sorted at the end of the crawl
+    sitemap_queue.put_nowait(canonicalize_url(url))
+
+    try:
+        status, html = await fetch_page(session, url)
+        if status == 200:
+            # Only hrefs are needed, so scan the raw bytes instead of building a tree
+            hrefs = HREF_PATTERN.findall(html)
+            enqueue_links(hrefs, base, base_netloc, visited_urls, queue)
+        else:
+            log.warning(f"Failed to retrieve data from {url}. Status code: {status}")
+    except asyncio.TimeoutError:
+        log.warning(f"Max retries reached for {url}. Moving on...")
+    except Exception as e:
+        log.error(f"An error occurred for {url}: {e}")
+
+async def write_sitemap(file, sitemap_queue):
+    # The only coroutine touching the sitemap file; URLs are written in chunks
+    loop = asyncio.get_running_loop()
+    while True:
+        urls = [await sitemap_queue.get()]
+        deadline = loop.time() + SITEMAP_FLUSH_INTERVAL
+        while len(urls) < SITEMAP_FLUSH_EVERY:
+            try:
+                urls.append(await asyncio.wait_for(sitemap_queue.get(), timeout=deadline - loop.time()))
+            except asyncio.TimeoutError:
                 break
-        except asyncio.TimeoutError:
-            if attempt < max_retries - 1:
-                print(f"Timeout occurred for {url}. Retrying... (Attempt {attempt + 1}/{max_retries})")
-                await asyncio.sleep(1)
-            else:
-                print(f"Max retries reached for {url}. Moving on...")
-        except Exception as e:
-            print(f"An error occurred for {url}: {e}")
-            break
+
+        await file.write(''.join(url + '\n' for url in urls))
+        await file.flush()
+        for _ in urls:
+            sitemap_queue.task_done()
+
+async def get_internal_links(session, base_url, url, visited_urls, file):
+    # Pending URLs are shared by a fixed pool of workers instead of recursing per page
+    queue = asyncio.Queue()
+    seed = URL(url)
+    visited_urls.add(crawl_key(seed))
+    queue.put_nowait(seed)
+
+    # Parse the base URL once rather than for every link on every page
+    base = URL(base_url)
+    base_netloc = base.raw_authority
+
+    async def worker():
+        while True:
+            next_url = await queue.get()
+            try:
+                await crawl_page(session, base, base_netloc, next_url, visited_urls, sitemap_queue, queue)
+            finally:
+                queue.task_done()
+
+    sitemap_queue = asyncio.Queue()
+    workers = [asyncio.create_task(worker()) for _ in range(CRAWL_WORKERS)]
+    workers.append(asyncio.create_task(write_sitemap(file, sitemap_queue)))
+
+    # join() returns once the queue is empty and no page is still in flight
+    await queue.join()
+    await sitemap_queue.join()
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+def setup_logging():
+    # Records are written to stdout by a background thread, so the event loop never blocks on the terminal
+    log_queue = SimpleQueue()
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(logging.INFO)
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+def create_session():
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_CONNECTION_LIMIT,
+        limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+        ttl_dns_cache=600,
+        resolver=aiohttp.AsyncResolver(),
+        enable_cleanup_closed=True,
+    )
+    timeout = aiohttp.ClientTimeout(total=30, connect=10)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HTTP_HEADERS)
 
 async def main():
     homepage_url = input("Enter the homepage URL you'd like to crawl: ")
@@ -180,49 +652,46 @@ async def main():
     if not homepage_url.startswith(('http://', 'https://')):
         homepage_url = 'http://' + homepage_url
 
-    print(f"Starting to crawl from: {homepage_url}")
+    log.info(f"Starting to crawl from: {homepage_url}")
 
     folder_name = urlparse(homepage_url).netloc
     os.makedirs(folder_name, exist_ok=True)
     file_name = os.path.join(folder_name, "full_sitemap.txt")
-    visited_urls = set()
+    visited_urls = VisitedUrls()
 
-    async with aiohttp.ClientSession() as session:
-        with open(file_name, 'w', encoding='utf-8') as file:
+    # Keep the connection pool and DNS cache warm from the crawl into product fetching
+    async with create_session() as session:
+        async with aiofiles.open(file_name, 'w', encoding='utf-8') as file:
             await get_internal_links(session, homepage_url, homepage_url, visited_urls, file)
 
-    print(f"Crawling completed. Sorting URLs...")
-    
-    # Read the file, normalize and deduplicate URLs, then sort them
-    with open(file_name, 'r', encoding='utf-8') as file:
-        urls = file.readlines()
-    
-    # Normalize and deduplicate URLs
-    normalized_urls = set()
-    for url in urls:
-        # Remove whitespace, convert to lowercase, and remove trailing slashes
-        normalized_url = url.strip().lower().rstrip('/')
-        # Remove query parameters
-        normalized_url = normalized_url.split('?')[0]
-        normalized_urls.add(normalized_url)
-    
-    sorted_urls = sorted(normalized_urls)
-    
-    with open(file_name, 'w', encoding='utf-8') as file:
-        for url in sorted_urls:
-            file.write(url + '\n')
-
-    print(f"All internal links have been saved and sorted in {file_name}")
-    print(f"Total unique URLs found: {len(sorted_urls)}")
-
-    # Process product URLs
-    product_urls = [url for url in sorted_urls if '/products/' in url]
-    print(f"Found {len(product_urls)} unique product URLs. Processing with Jina AI...")
-
-    async with aiohttp.ClientSession() as session:
+        log.info("Crawling completed. Sorting URLs...")
+
+        # URLs were normalized during the crawl, so an exact set removes the repeats.
+        # The visited filter cannot be iterated, so the sitemap file is the list of URLs
+        async with aiofiles.open(file_name, 'r', encoding='utf-8') as file:
+            sorted_urls = sorted(set((await file.read()).splitlines()))
+
+        async with aiofiles.open(file_name, 'w', encoding='utf-8') as file:
+            await file.write(''.join(url + '\n' for url in sorted_urls))
+
+        log.info(f"All internal links have been saved and sorted in {file_name}")
+        log.info(f"Total unique URLs found: {len(sorted_urls)}")
+
+        # Process product URLs
+        product_urls = [url for url in sorted_urls if '/products/' in url]
+        log.info(f"Found {len(product_urls)} unique product URLs. Processing with Jina AI...")
+
         await process_product_urls(session, product_urls, folder_name)
 
-    print("Finished processing product URLs with Jina AI.")
+        log.info("Finished processing product URLs with Jina AI.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    listener = setup_logging()
+    try:
+        # uvloop's libuv-based event loop is a drop-in replacement for asyncio's default
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
+    finally:
+        listener.stop()